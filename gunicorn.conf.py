@@ -0,0 +1,27 @@
+"""
+Конфигурация gunicorn для продакшена
+Запуск: gunicorn -c gunicorn.conf.py telegram_music_api:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+
+# gthread воркер отдает файлы через sendfile(2), пока потоки обслуживают /api/*.
+# Воркер один: треки, счетчики прослушиваний и Telegram бот живут в памяти процесса.
+worker_class = 'gthread'
+workers = 1
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+keepalive = 5
+
+accesslog = '-'
+
+def post_worker_init(worker):
+    """Запуск Telegram бота внутри воркера"""
+    from telegram_music_api import start_telegram_thread
+    start_telegram_thread()
+
+def worker_exit(server, worker):
+    """Остановка Telegram бота при завершении воркера"""
+    from telegram_music_api import stop_telegram_thread
+    stop_telegram_thread()
@@ -4,69 +4,622 @@ Telegram Music Bot + API Server - Финальная рабочая версия
 Исправлены все проблемы с webhook и event loop
 """
 
+from __future__ import annotations
+
 import os
+import sys
 import asyncio
 import logging
-import json
 import hashlib
+import re
+import heapq
+import functools
 from datetime import datetime
 import threading
 import uuid
 from pathlib import Path
-import queue
+from urllib.parse import quote
 import mimetypes
+import mmap
+import fcntl
+import sqlite3
+import atexit
+from collections import defaultdict, Counter
+from array import array
+from typing import TYPE_CHECKING
 
-# Telegram
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+# Telegram и httpx импортируются лениво, только когда бот настроен:
+# в режиме "только API" они не нужны, а импорт telegram.ext заметно тормозит старт
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 # Web API
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, request, send_file, Response
+from flask.json.provider import JSONProvider
+
+# orjson заметно быстрее stdlib json, но сервер работает и без него
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+if __name__ == "__main__":
+    # Локальный запуск - тот же gunicorn, что и на Render (бот стартует в post_worker_init).
+    # exec до кода ниже: база, журнал прослушиваний и поток записи принадлежат воркеру
+    gunicorn_config = Path(__file__).with_name('gunicorn.conf.py')
+    os.execvp(sys.executable, [
+        sys.executable, '-m', 'gunicorn',
+        '-c', str(gunicorn_config),
+        'telegram_music_api:app'
+    ])
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx на уровне INFO пишет URL запросов вместе с токеном бота
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Публичный адрес сервера для ссылок в ответах бота
+BASE_URL = WEBHOOK_URL or "https://telegram-music-bot-api-server.onrender.com"
 PORT = int(os.getenv('PORT', 10000))
+# Префикс internal location nginx (например /internal/music/) - тогда файлы отдает nginx
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '')
+
+# Все, кроме букв, цифр, пробела, '-' и '_' - вырезается из названий
+SANITIZE_RE = re.compile(r'[^\w \-]+')
+# Управляющие символы в запросе поиска (NUL FTS5 не разбирает)
+CONTROL_CHARS_RE = re.compile(r'[\x00-\x1f\x7f]')
 
 # Создание директорий
 MUSIC_DIR = Path("music")
 MUSIC_DIR.mkdir(exist_ok=True)
 
-# Простое хранилище треков
+# Простое хранилище треков (in-memory кэш поверх SQLite)
 tracks_storage = {}
 
-# Очередь для обработки Telegram updates
-update_queue = queue.Queue()
+# Публичное представление треков (без file_path/file_id) для API - сразу в виде
+# готовых JSON-фрагментов: {track_id: bytes}. Отдельные словари не храним
+public_fragments = {}
+
+# Колонки в порядке загрузки (загрузки только дописываются в конец):
+# upload_order[i] - ID трека, play_counts[i] - его прослушивания
+upload_order = []
+play_counts = array('Q')
+track_positions = {}
+
+# Сериализованный ответ /api/tracks и его ETag; сбрасывается при любом изменении треков
+tracks_version = 0
+tracks_json_cache = None
+tracks_cache_lock = threading.Lock()
+TRACKS_MAX_AGE = 5  # секунд
+
+# Общее число прослушиваний (поддерживается инкрементально)
+total_plays = 0
+
+# Число загруженных треков по пользователям: {user_id: count}
+user_track_counts = Counter()
+
+# Заранее приведенные к нижнему регистру title/artist: {track_id: (title, artist)}
+search_index = {}
+
+# Уже загруженные файлы Telegram: {file_id: track_id}
+tracks_by_file_id = {}
+
+# Триграммный индекс для поиска подстрок без FTS5: {триграмма: {track_id, ...}}
+trigram_index = defaultdict(set)
+
+# Ограничение одновременно обрабатываемых Telegram updates
+MAX_UPDATES_IN_FLIGHT = 100
+updates_in_flight = threading.BoundedSemaphore(MAX_UPDATES_IN_FLIGHT)
+
+# Telegram приложение (None в API-only режиме) и его event loop
+telegram_app = None
+bot_loop = None
+
+# Поток бота и потокобезопасная функция его остановки (для worker_exit в gunicorn)
+bot_thread = None
+bot_stop = None
+
+# HTTP клиент для скачивания файлов из Telegram: создается в event loop бота
+# при первой загрузке и дальше переиспользует соединения
+download_client = None
+
+# SQLite база треков + FTS5 индекс для поиска
+DB_PATH = MUSIC_DIR / "tracks.db"
+TRACK_COLUMNS = ('id', 'file_id', 'title', 'artist', 'file_path',
+                 'duration', 'user_id', 'uploaded_at', 'play_count')
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    file_id TEXT,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    duration INTEGER DEFAULT 0,
+    user_id INTEGER,
+    uploaded_at TEXT DEFAULT '',
+    play_count INTEGER DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS tracks_uploaded_at ON tracks (uploaded_at);
+
+-- Последнее поколение журнала прослушиваний, уже записанное в tracks
+CREATE TABLE IF NOT EXISTS plays_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    applied_generation INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO plays_state (id, applied_generation) VALUES (1, 0);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, artist,
+    content='tracks', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts(rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, artist ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+    INSERT INTO tracks_fts(rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+END;
+"""
+
+INSERT_TRACK_SQL = (
+    f"INSERT OR IGNORE INTO tracks ({', '.join(TRACK_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(TRACK_COLUMNS))})"
+)
+
+db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+db.row_factory = sqlite3.Row
+db_lock = threading.Lock()
+
+# Сериализует добавление треков в память (загрузки могут идти параллельно)
+tracks_lock = threading.Lock()
+
+# Сборка SQLite может быть без FTS5 - тогда ищем по search_index
+fts_enabled = True
+
+# Отложенная запись счетчиков прослушиваний
+# Нулевые и отрицательные значения превратили бы ожидание потока записи в busy loop
+PLAYS_FLUSH_INTERVAL = max(float(os.getenv('PLAYS_FLUSH_INTERVAL', 5)), 0.5)  # секунд
+PLAYS_FLUSH_BATCH = max(int(os.getenv('PLAYS_FLUSH_BATCH', 500)), 1)  # столько прослушиваний записываем, не дожидаясь интервала
+pending_plays = defaultdict(int)
+pending_total = 0
+plays_lock = threading.Lock()
+plays_cond = threading.Condition(plays_lock)
+
+# Журнал прослушиваний: по строке track_id на каждое прослушивание до flush.
+# При flush plays.log становится сегментом plays.<поколение>.log; поколение
+# записывается в plays_state той же транзакцией, что и счетчики, поэтому
+# повторное применение сегмента после падения ничего не удваивает
+PLAYS_LOG = MUSIC_DIR / "plays.log"
+PLAYS_LOG_FLUSHING = MUSIC_DIR / "plays.log.flushing"  # журнал старого формата
+plays_log = None
+plays_generation = 0  # последнее выданное поколение
+
+# Журналом владеет один процесс: при HUP reload новый воркер стартует, пока старый
+# еще отдает запросы и при выходе записывает свои прослушивания
+PLAYS_LOCK = MUSIC_DIR / "plays.lock"
+plays_lock_file = None
 
-def save_tracks():
-    """Сохранить треки на диск"""
+# Сегменты журнала, еще не записанные в базу: {поколение: {track_id: count}}
+unapplied_plays = {}
+# Сегменты применяются строго по порядку поколений, одним потоком за раз
+flush_lock = threading.Lock()
+
+def plays_segment(generation):
+    """Путь сегмента журнала данного поколения"""
+    return MUSIC_DIR / f"plays.{generation}.log"
+
+def track_to_row(track):
+    """Кортеж значений трека в порядке TRACK_COLUMNS"""
+    return (
+        track['id'],
+        track.get('file_id'),
+        track['title'],
+        track['artist'],
+        track['file_path'],
+        track.get('duration', 0),
+        track.get('user_id'),
+        track.get('uploaded_at', ''),
+        track.get('play_count', 0)
+    )
+
+def init_db():
+    """Создать таблицы и перенести старый tracks.json в SQLite"""
+    global fts_enabled
+    with db_lock:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(DB_SCHEMA)
+        try:
+            db.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            fts_enabled = False
+            logger.warning(f"FTS5 unavailable, falling back to in-memory search: {e}")
+    
+    legacy_file = MUSIC_DIR / "tracks.json"
+    if not legacy_file.exists():
+        return
+    
     try:
-        with open(MUSIC_DIR / "tracks.json", 'w', encoding='utf-8') as f:
-            json.dump(tracks_storage, f, ensure_ascii=False, indent=2)
+        # mmap вместо read(): не держим в памяти отдельную копию байтов файла
+        with open(legacy_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            legacy_tracks = json_loads(memoryview(mm))
+        with db_lock, db:
+            db.execute("BEGIN")
+            db.executemany(INSERT_TRACK_SQL, [track_to_row(track) for track in legacy_tracks.values()])
+        legacy_file.rename(legacy_file.with_suffix('.json.migrated'))
+        logger.info(f"Migrated {len(legacy_tracks)} tracks from tracks.json")
     except Exception as e:
-        logger.error(f"Save error: {e}")
+        logger.error(f"Migration error: {e}")
+
+def make_public(track):
+    """Публичные поля трека для ответов API"""
+    return {
+        'id': track['id'],
+        'title': track['title'],
+        'artist': track['artist'],
+        'duration': track.get('duration', 0),
+        'uploaded_at': track.get('uploaded_at', ''),
+        'play_count': track.get('play_count', 0)
+    }
+
+def json_dumps(obj):
+    """Сериализовать в JSON bytes"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def json_loads(data):
+    """Разобрать JSON из bytes/memoryview"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def invalidate_tracks_cache():
+    """Сбросить кэш ответа /api/tracks после изменения треков"""
+    global tracks_version, tracks_json_cache
+    with tracks_cache_lock:
+        tracks_version += 1
+        tracks_json_cache = None
+
+def trigrams(text):
+    """Множество триграмм строки"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def cache_track(track):
+    """Заполнить производные поля и публичное представление"""
+    track['mime_type'] = mimetypes.guess_type(track['file_path'])[0] or 'audio/mpeg'
+    public_fragments[track['id']] = json_dumps(make_public(track))
+    if track.get('file_id'):
+        tracks_by_file_id[track['file_id']] = track['id']
+    search_index[track['id']] = (track['title'].lower(), track['artist'].lower())
+
+def index_track(track):
+    """Добавить трек в триграммный индекс - после этого его находит поиск"""
+    title, artist = search_index[track['id']]
+    for gram in trigrams(title) | trigrams(artist):
+        trigram_index[gram].add(track['id'])
 
 def load_tracks():
-    """Загрузить треки с диска"""
-    global tracks_storage
+    """Загрузить треки из базы в память"""
+    global tracks_storage, total_plays, upload_order, play_counts, track_positions, user_track_counts
     try:
-        tracks_file = MUSIC_DIR / "tracks.json"
-        if tracks_file.exists():
-            with open(tracks_file, 'r', encoding='utf-8') as f:
-                tracks_storage = json.load(f)
-                logger.info(f"Loaded {len(tracks_storage)} tracks")
+        # Итерируемся по курсору без fetchall(), чтобы не держать все строки дважды
+        with db_lock:
+            # Строки сразу идут по дате загрузки (по индексу) - сортировать в Python не нужно
+            cursor = db.execute(
+                f"SELECT {', '.join(TRACK_COLUMNS)} FROM tracks ORDER BY uploaded_at, rowid"
+            )
+            tracks_storage = {row['id']: dict(row) for row in cursor}
+        # Прослушивания, которые еще не удалось записать в базу, тоже учитываем
+        with plays_lock:
+            for counts in (*unapplied_plays.values(), pending_plays):
+                for track_id, count in counts.items():
+                    if track_id in tracks_storage:
+                        tracks_storage[track_id]['play_count'] += count
+        for track in tracks_storage.values():
+            cache_track(track)
+            index_track(track)
+        upload_order = list(tracks_storage)
+        play_counts = array('Q', (tracks_storage[track_id].get('play_count', 0) for track_id in upload_order))
+        track_positions = {track_id: i for i, track_id in enumerate(upload_order)}
+        total_plays = sum(play_counts)
+        user_track_counts = Counter(track.get('user_id') for track in tracks_storage.values())
+        invalidate_tracks_cache()
+        logger.info(f"Loaded {len(tracks_storage)} tracks")
     except Exception as e:
         logger.error(f"Load error: {e}")
 
+def add_track(track):
+    """Добавить трек в базу и в память"""
+    with db_lock:
+        db.execute(INSERT_TRACK_SQL, track_to_row(track))
+    # Читатели работают без блокировки, поэтому трек публикуется по шагам:
+    # JSON-фрагмент и колонки заполняются раньше, чем id попадет в tracks_storage
+    # (строка в FTS уже есть), upload_order и поисковый индекс
+    with tracks_lock:
+        cache_track(track)
+        track_positions[track['id']] = len(upload_order)
+        play_counts.append(track.get('play_count', 0))
+        tracks_storage[track['id']] = track
+        upload_order.append(track['id'])
+        index_track(track)
+        user_track_counts[track.get('user_id')] += 1
+    invalidate_tracks_cache()
+
+def increment_play_count(track_id):
+    """Увеличить счетчик прослушиваний (в базу попадет при следующем flush)"""
+    global total_plays, pending_total
+    track = tracks_storage[track_id]
+    with plays_lock:
+        track['play_count'] = track.get('play_count', 0) + 1
+        public_fragments[track_id] = json_dumps(make_public(track))
+        play_counts[track_positions[track_id]] += 1
+        pending_plays[track_id] += 1
+        pending_total += 1
+        total_plays += 1
+        plays_log.write(f"{track_id}\n")
+        if pending_total >= PLAYS_FLUSH_BATCH:
+            plays_cond.notify()
+    invalidate_tracks_cache()
+
+def apply_play_counts(counts, generation):
+    """Прибавить прослушивания сегмента к счетчикам в базе одной транзакцией"""
+    with db_lock, db:
+        db.execute("BEGIN")
+        db.executemany(
+            "UPDATE tracks SET play_count = play_count + ? WHERE id = ?",
+            [(count, track_id) for track_id, count in counts.items()]
+        )
+        db.execute("UPDATE plays_state SET applied_generation = ? WHERE id = 1", (generation,))
+
+def rotate_plays_log():
+    """Закрыть текущий журнал как новый сегмент (вызывается под plays_lock)"""
+    global pending_plays, pending_total, plays_log, plays_generation
+    plays_generation += 1
+    plays_log.close()
+    os.replace(PLAYS_LOG, plays_segment(plays_generation))
+    plays_log = open(PLAYS_LOG, 'a', buffering=1, encoding='utf-8')
+    unapplied_plays[plays_generation] = pending_plays
+    pending_plays = defaultdict(int)
+    pending_total = 0
+
+def flush_play_counts():
+    """Записать накопленные прослушивания в базу и начать новый журнал"""
+    with flush_lock:
+        with plays_lock:
+            if pending_plays:
+                rotate_plays_log()
+            generations = sorted(unapplied_plays)
+        
+        for generation in generations:
+            try:
+                apply_play_counts(unapplied_plays[generation], generation)
+            except Exception as e:
+                # Сегмент остается на диске и в памяти - повторим при следующем flush
+                logger.error(f"Save error: {e}")
+                return
+            with plays_lock:
+                del unapplied_plays[generation]
+            plays_segment(generation).unlink(missing_ok=True)
+
+def lock_plays_journal():
+    """Дождаться, пока журнал прослушиваний освободит предыдущий воркер"""
+    global plays_lock_file
+    # Блокировка держится до выхода процесса и снимается уже после atexit flush
+    plays_lock_file = open(PLAYS_LOCK, 'a')
+    try:
+        fcntl.flock(plays_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("Waiting for the previous worker to release plays.log")
+        fcntl.flock(plays_lock_file, fcntl.LOCK_EX)
+
+def replay_plays_log():
+    """Применить прослушивания, оставшиеся в журнале после падения процесса"""
+    global plays_log, plays_generation
+    with db_lock:
+        applied = db.execute("SELECT applied_generation FROM plays_state").fetchone()[0]
+    
+    segments = {}
+    for path in MUSIC_DIR.glob('plays.*.log'):
+        try:
+            segments[int(path.name.split('.')[1])] = path
+        except ValueError:
+            continue
+    plays_generation = max([applied, *segments])
+    
+    # Журналы без поколения (текущий и старого формата) становятся новыми сегментами
+    for path in (PLAYS_LOG_FLUSHING, PLAYS_LOG):
+        if path.exists():
+            plays_generation += 1
+            os.replace(path, plays_segment(plays_generation))
+            segments[plays_generation] = plays_segment(plays_generation)
+    
+    for generation, path in sorted(segments.items()):
+        if generation <= applied:
+            # Уже в базе: процесс упал между commit и удалением сегмента
+            path.unlink(missing_ok=True)
+            continue
+        counts = defaultdict(int)
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    counts[line.strip()] += 1
+        unapplied_plays[generation] = counts
+    
+    plays_log = open(PLAYS_LOG, 'a', buffering=1, encoding='utf-8')
+    if unapplied_plays:
+        replayed = sum(sum(counts.values()) for counts in unapplied_plays.values())
+        flush_play_counts()
+        logger.info(f"Replayed {replayed} plays from plays.log")
+
+def play_counts_flusher():
+    """Фоновый поток записи счетчиков: раз в интервал или при накоплении пачки"""
+    while True:
+        with plays_cond:
+            plays_cond.wait_for(lambda: pending_total >= PLAYS_FLUSH_BATCH, timeout=PLAYS_FLUSH_INTERVAL)
+        flush_play_counts()
+
+def find_duplicate(audio):
+    """Найти уже сохраненный трек с тем же файлом Telegram"""
+    track_id = tracks_by_file_id.get(audio.file_id)
+    if track_id not in tracks_storage:
+        return None
+    track = tracks_storage[track_id]
+    try:
+        size = os.stat(track['file_path']).st_size
+    except OSError:
+        return None
+    # Файл на диске должен быть целым, иначе качаем заново
+    if size == 0 or (audio.file_size and size != audio.file_size):
+        return None
+    return track
+
+def commit_file(tmp_path, file_path):
+    """Сбросить данные файла на диск и атомарно переместить на место"""
+    with open(tmp_path, 'rb') as f:
+        # fdatasync не трогает метаданные inode; где его нет - обычный fsync
+        getattr(os, 'fdatasync', os.fsync)(f.fileno())
+        # Записанные страницы уже на диске - выкидываем их из page cache,
+        # чтобы загрузка не вытесняла часто проигрываемые треки
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    os.replace(tmp_path, file_path)
+
+def store_upload(tmp_path, file_path):
+    """Положить скачанный файл на место или выбросить его, если такой уже есть"""
+    if file_path.exists():
+        tmp_path.unlink()
+    else:
+        commit_file(tmp_path, file_path)
+
+async def stream_download(url, file_path, chunk_size=64 * 1024):
+    """Скачать файл по частям, не держа его целиком в памяти; вернуть SHA-256 содержимого"""
+    global download_client
+    import httpx
+    if download_client is None:
+        download_client = httpx.AsyncClient(timeout=httpx.Timeout(60.0))
+    
+    try:
+        async with download_client.stream('GET', url) as response:
+            response.raise_for_status()
+            digest = hashlib.sha256()
+            # Запись на диск - в пуле потоков, чтобы не блокировать event loop бота
+            f = await asyncio.to_thread(open, file_path, 'wb')
+            try:
+                async for chunk in response.aiter_bytes(chunk_size):
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    except httpx.HTTPError as e:
+        # Текст ошибок httpx содержит URL файла, а в нем токен бота
+        if isinstance(e, httpx.HTTPStatusError):
+            reason = f"HTTP {e.response.status_code}"
+        else:
+            reason = type(e).__name__
+        raise RuntimeError(f"File download failed: {reason}") from None
+    return digest.hexdigest()
+
+def build_fts_query(query):
+    """Преобразовать пользовательский запрос в FTS5 MATCH с префиксным поиском"""
+    terms = []
+    for word in CONTROL_CHARS_RE.sub(' ', query).split():
+        word = word.replace('"', '""')
+        terms.append(f'"{word}"*')
+    return ' '.join(terms)
+
+def substring_search(query):
+    """Поиск подстроки через триграммный индекс"""
+    query = query.lower()
+    grams = trigrams(query)
+    if grams:
+        # Кандидаты - пересечение posting-листов, начиная с самого короткого;
+        # позиция в upload_order совпадает с порядком по uploaded_at
+        postings = sorted((trigram_index.get(gram, set()) for gram in grams), key=len)
+        candidates = sorted(postings[0].intersection(*postings[1:]), key=track_positions.__getitem__)
+    else:
+        # Запрос короче триграммы - проверяем все треки, они уже идут по дате загрузки
+        candidates = upload_order
+    
+    return [
+        tracks_storage[track_id]
+        for track_id in candidates
+        if query in search_index[track_id][0] or query in search_index[track_id][1]
+    ]
+
+def fts_search(query):
+    """Поиск по словам (с префиксами) через FTS5 индекс"""
+    fts_query = build_fts_query(query)
+    if not fts_query:
+        return []
+    
+    try:
+        with db_lock:
+            rows = db.execute(
+                "SELECT tracks.id FROM tracks_fts "
+                "JOIN tracks ON tracks.rowid = tracks_fts.rowid "
+                "WHERE tracks_fts MATCH ? ORDER BY rank",
+                (fts_query,)
+            ).fetchall()
+    except sqlite3.OperationalError as e:
+        # Запрос, который FTS5 не разобрал, - остаются результаты по триграммам
+        logger.warning(f"FTS query failed: {e}")
+        return []
+    return [tracks_storage[row['id']] for row in rows if row['id'] in tracks_storage]
+
+def find_tracks(query):
+    """Найти треки по названию/исполнителю"""
+    results = fts_search(query) if fts_enabled else []
+    
+    # FTS5 находит только начала слов - середину слова всегда ищем по триграммам
+    # и добавляем после ранжированных FTS-совпадений
+    seen = {track['id'] for track in results}
+    results.extend(track for track in substring_search(query) if track['id'] not in seen)
+    return results
+
 # Загружаем треки при старте
+init_db()
+lock_plays_journal()
+replay_plays_log()
 load_tracks()
 
+threading.Thread(target=play_counts_flusher, daemon=True).start()
+atexit.register(flush_play_counts)
+
+class OrjsonProvider(JSONProvider):
+    """request.get_json через orjson (ответы отдает json_response)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Flask приложение
 app = Flask(__name__)
+if orjson:
+    app.json = OrjsonProvider(app)
+
+def json_response(payload, status=200):
+    """JSON ответ через orjson, если он установлен (все JSON ответы API идут через него)"""
+    return Response(json_dumps(payload), status=status, mimetype='application/json')
 
 @app.after_request
 def add_cors_headers(response):
@@ -76,13 +629,8 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
     return response
 
-@app.route('/')
-def home():
-    """Главная страница с веб-плеером"""
-    tracks_count = len(tracks_storage)
-    bot_status = 'Настроен ✅' if BOT_TOKEN else 'Не настроен ❌'
-    
-    return f"""
+# Шаблон главной страницы собирается один раз при импорте
+HOME_TEMPLATE = """
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -143,22 +691,22 @@ def home():
                 
                 <div class="endpoint">
                     <strong>GET /api/tracks</strong> - Все треки<br>
-                    <code>curl {request.host_url}api/tracks</code>
+                    <code>curl {host_url}api/tracks</code>
                 </div>
                 
                 <div class="endpoint">
                     <strong>GET /api/search?q=запрос</strong> - Поиск<br>
-                    <code>curl "{request.host_url}api/search?q=music"</code>
+                    <code>curl "{host_url}api/search?q=music"</code>
                 </div>
                 
                 <div class="endpoint">
                     <strong>GET /api/play/&lt;id&gt;</strong> - Воспроизведение<br>
-                    <code>curl {request.host_url}api/play/12345</code>
+                    <code>curl {host_url}api/play/12345</code>
                 </div>
                 
                 <div class="endpoint">
                     <strong>GET /api/download/&lt;id&gt;</strong> - Скачивание<br>
-                    <code>curl -O {request.host_url}api/download/12345</code>
+                    <code>curl -O {host_url}api/download/12345</code>
                 </div>
             </div>
             
@@ -225,37 +773,73 @@ def home():
     </html>
     """
 
+# Статус и режим бота не меняются за время жизни процесса - вшиваем в страницу один раз
+if not BOT_TOKEN:
+    BOT_STATUS = 'Не настроен ❌'
+elif WEBHOOK_URL:
+    BOT_STATUS = 'Настроен ✅ (webhook)'
+else:
+    BOT_STATUS = 'Настроен ✅ (polling)'
+
+# Меняется только число треков: страница режется по нему на две готовые части
+HOME_HEAD, HOME_TAIL = HOME_TEMPLATE.split('{tracks_count}')
+HOME_HEAD = HOME_HEAD.format().encode('utf-8')
+
+@functools.lru_cache(maxsize=8)
+def render_home_tail(host_url):
+    """Вторая часть страницы в bytes для данного адреса сервера"""
+    return HOME_TAIL.format(bot_status=BOT_STATUS, host_url=host_url).encode('utf-8')
+
+@app.route('/')
+def home():
+    """Главная страница с веб-плеером"""
+    body = b''.join((
+        HOME_HEAD,
+        str(len(tracks_storage)).encode(),
+        render_home_tail(request.host_url)
+    ))
+    return Response(body, mimetype='text/html')
+
 @app.route('/health')
 def health_check():
     """Health check для мониторинга"""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'tracks_count': len(tracks_storage),
-        'bot_configured': bool(BOT_TOKEN)
+        'bot_configured': bool(BOT_TOKEN),
+        'bot_ready': bool(telegram_app and telegram_app.running)
     })
 
 @app.route('/api/tracks')
 def get_tracks():
     """Получить все треки"""
-    safe_tracks = []
-    for track in tracks_storage.values():
-        safe_track = {
-            'id': track['id'],
-            'title': track['title'],
-            'artist': track['artist'],
-            'duration': track.get('duration', 0),
-            'uploaded_at': track.get('uploaded_at', ''),
-            'play_count': track.get('play_count', 0)
-        }
-        safe_tracks.append(safe_track)
-    
-    # Сортируем по дате загрузки (новые сначала)
-    safe_tracks.sort(key=lambda x: x['uploaded_at'], reverse=True)
-    
-    return jsonify({
-        'tracks': safe_tracks,
-        'count': len(safe_tracks)
-    })
+    global tracks_json_cache
+    cached = tracks_json_cache
+    
+    if cached is None:
+        version = tracks_version
+        
+        # Склеиваем готовые фрагменты по дате загрузки (новые сначала)
+        body = b''.join((
+            b'{"tracks":[',
+            b','.join(public_fragments[track_id] for track_id in reversed(upload_order)),
+            f'],"count":{len(upload_order)}}}'.encode()
+        ))
+        # ETag от содержимого - не зависит от перезапусков сервера
+        cached = (body, hashlib.blake2b(body, digest_size=8).hexdigest())
+        
+        # Кэшируем, только если треки не изменились за время сериализации
+        with tracks_cache_lock:
+            if version == tracks_version:
+                tracks_json_cache = cached
+    
+    body, etag = cached
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Несколько секунд клиент берет список из своего кэша, дальше - проверка по ETag
+    response.headers['Cache-Control'] = f'public, max-age={TRACKS_MAX_AGE}'
+    # Если у клиента та же версия - 304 без тела
+    return response.make_conditional(request)
 
 @app.route('/api/search')
 def search_tracks():
@@ -263,88 +847,105 @@ def search_tracks():
     query = request.args.get('q', '').strip().lower()
     
     if not query:
-        return jsonify({'error': 'Query parameter "q" is required'}), 400
+        return json_response({'error': 'Query parameter "q" is required'}, 400)
     
-    results = []
-    for track in tracks_storage.values():
-        if (query in track['title'].lower() or 
-            query in track['artist'].lower()):
-            
-            safe_track = {
-                'id': track['id'],
-                'title': track['title'],
-                'artist': track['artist'],
-                'duration': track.get('duration', 0),
-                'play_count': track.get('play_count', 0)
-            }
-            results.append(safe_track)
-    
-    return jsonify({
-        'query': query,
-        'tracks': results,
-        'count': len(results)
-    })
+    results = find_tracks(query)
+    
+    # Как и в /api/tracks, склеиваем готовые фрагменты вместо сериализации словарей
+    body = b''.join((
+        b'{"query":',
+        json_dumps(query),
+        b',"tracks":[',
+        b','.join(public_fragments[track['id']] for track in results),
+        f'],"count":{len(results)}}}'.encode()
+    ))
+    return Response(body, mimetype='application/json')
+
+def send_track(track, download_name, as_attachment=False):
+    """Ответ с аудиофайлом трека"""
+    if X_ACCEL_PREFIX:
+        # nginx сам отдаст файл через sendfile, включая Range-запросы
+        disposition = 'attachment' if as_attachment else 'inline'
+        response = Response(mimetype=track['mime_type'])
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + Path(track['file_path']).name
+        response.headers['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(download_name)}"
+        return response
+    
+    # Размер и mtime берем fstat'ом уже открытого файла: без отдельного stat по пути
+    f = open(track['file_path'], 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        
+        # send_file отдает файл через wsgi.file_wrapper (sendfile); ETag и Range
+        # обрабатываем сами один раз, уже зная размер файла
+        response = send_file(
+            f,
+            mimetype=track['mime_type'],
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=False,
+            # Файл трека не меняется после загрузки - ID достаточно для ETag
+            etag=track['id'],
+            last_modified=st.st_mtime
+        )
+        response.content_length = st.st_size
+        response = response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+        
+        # На Range-запрос Werkzeug читает файл в Python-цикле, и sendfile не используется.
+        # Плеер почти всегда просит "bytes=N-" (до конца файла) - такой диапазон отдаем
+        # через wsgi.file_wrapper с файлом, сдвинутым на начало диапазона
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        content_range = response.content_range
+        if (file_wrapper is not None and response.status_code == 206
+                and content_range.stop == content_range.length):
+            f.seek(content_range.start)
+            response.response = file_wrapper(f)
+    except Exception:
+        f.close()
+        raise
+    
+    return response
 
 @app.route('/api/play/<track_id>')
 def play_track(track_id):
     """Воспроизведение трека"""
     if track_id not in tracks_storage:
-        return jsonify({'error': 'Track not found'}), 404
+        return json_response({'error': 'Track not found'}, 404)
     
     track = tracks_storage[track_id]
-    file_path = track['file_path']
-    
-    if not os.path.exists(file_path):
-        return jsonify({'error': 'Audio file not found'}), 404
-    
-    # Увеличиваем счетчик прослушиваний
-    tracks_storage[track_id]['play_count'] = tracks_storage[track_id].get('play_count', 0) + 1
-    save_tracks()
-    
-    def generate_audio():
-        with open(file_path, 'rb') as audio_file:
-            while True:
-                chunk = audio_file.read(8192)  # 8KB chunks
-                if not chunk:
-                    break
-                yield chunk
-    
-    return Response(
-        generate_audio(),
-        mimetype='audio/mpeg',
-        headers={
-            'Content-Disposition': f'inline; filename="{track["title"]}.mp3"',
-            'Accept-Ranges': 'bytes'
-        }
-    )
+    
+    # Отдельную проверку os.path.exists не делаем - отсутствие файла видно уже при open
+    try:
+        response = send_track(track, f"{track['title']}.mp3")
+    except FileNotFoundError:
+        return json_response({'error': 'Audio file not found'}, 404)
+    
+    # Увеличиваем счетчик прослушиваний; перемотка (Range не с начала файла), HEAD
+    # и 304 (файл уже есть у клиента, байты не отправляются) - не новое прослушивание
+    if (request.method == 'GET' and response.status_code in (200, 206)
+            and (request.range is None or request.range.ranges[0][0] == 0)):
+        increment_play_count(track_id)
+    
+    return response
 
 @app.route('/api/download/<track_id>')
 def download_track(track_id):
     """Скачивание трека"""
     if track_id not in tracks_storage:
-        return jsonify({'error': 'Track not found'}), 404
+        return json_response({'error': 'Track not found'}, 404)
     
     track = tracks_storage[track_id]
-    file_path = track['file_path']
-    
-    if not os.path.exists(file_path):
-        return jsonify({'error': 'Audio file not found'}), 404
-    
     filename = f"{track['artist']} - {track['title']}.mp3"
     
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=filename,
-        mimetype='audio/mpeg'
-    )
+    try:
+        return send_track(track, filename, as_attachment=True)
+    except FileNotFoundError:
+        return json_response({'error': 'Audio file not found'}, 404)
 
 @app.route('/api/stats')
 def get_stats():
     """Статистика сервера"""
-    total_plays = sum(track.get('play_count', 0) for track in tracks_storage.values())
-    
-    return jsonify({
+    return json_response({
         'total_tracks': len(tracks_storage),
         'total_plays': total_plays,
         'bot_configured': bool(BOT_TOKEN)
@@ -357,25 +958,45 @@ def telegram_webhook():
     if not BOT_TOKEN:
         return 'Bot not configured', 400
     
+    if bot_loop is None:
+        # Бот еще запускается - Telegram повторит доставку
+        return 'Bot not ready', 503
+    
+    update_data = request.get_json(silent=True)
+    if not update_data:
+        return 'OK'
+    
+    # Разбор update - в потоке запроса, event loop бота получает готовый объект
+    from telegram import Update
     try:
-        update_data = request.get_json()
-        if update_data:
-            # Добавляем update в очередь для обработки
-            update_queue.put(update_data)
+        update = Update.de_json(update_data, telegram_app.bot)
+    except Exception as e:
+        # Повторная доставка того же update не поможет - подтверждаем и пропускаем
+        logger.error(f"Invalid update: {e}")
+        return 'OK'
+    
+    if not updates_in_flight.acquire(blocking=False):
+        # Telegram повторит доставку позже
+        logger.warning("Too many updates in flight, rejecting webhook")
+        return 'Busy', 429
+    
+    try:
+        # Flask работает в своем потоке - запускаем обработку сразу в event loop бота
+        future = asyncio.run_coroutine_threadsafe(process_update(update), bot_loop)
+        future.add_done_callback(lambda _: updates_in_flight.release())
         return 'OK'
     except Exception as e:
+        updates_in_flight.release()
         logger.error(f"Webhook error: {e}")
         return 'Error', 500
 
 # Telegram бот функции
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Команда /start"""
-    user = update.effective_user
-    
-    welcome_text = f"""
+# Тексты ответов бота: статичная часть задается один раз при импорте,
+# в обработчиках подставляются только значения
+START_TEMPLATE = """
 🎵 *Музыкальный бот + API*
 
-Привет, {user.first_name}! 
+Привет, {first_name}! 
 
 *Возможности:*
 • 📤 Загрузка аудиофайлов (до 50MB)
@@ -392,6 +1013,54 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 *Инструкция:*
 Просто отправьте мне аудиофайл! 🎶
     """
+
+UPLOAD_TEMPLATE = """
+{header}
+
+🎵 *{title}*
+👤 {artist}
+⏱️ {minutes}:{seconds:02d}
+🆔 `{track_id}`
+
+*API ссылки:*
+▶️ Воспроизведение: `{base_url}/api/play/{track_id}`
+💾 Скачивание: `{base_url}/api/download/{track_id}`
+
+*Веб-плеер:* {base_url}
+        """
+
+STATS_TEMPLATE = """
+📊 *Статистика сервера*
+
+🎵 Всего треков: {total_tracks}
+▶️ Общее прослушиваний: {total_plays}
+👤 Ваших треков: {user_tracks}
+
+*Топ-3 треков:*
+"""
+
+API_TEXT = f"""
+🔗 *API Документация*
+
+*Базовый URL:* `{BASE_URL}`
+
+*Endpoints:*
+• `GET /api/tracks` - Все треки
+• `GET /api/search?q=запрос` - Поиск
+• `GET /api/play/ID` - Воспроизведение
+• `GET /api/download/ID` - Скачивание
+• `GET /api/stats` - Статистика
+
+*Веб-интерфейс:* {BASE_URL}
+    """
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /start"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    
+    user = update.effective_user
+    
+    welcome_text = START_TEMPLATE.format(first_name=user.first_name)
     
     keyboard = [
         [
@@ -400,7 +1069,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         ],
         [
             InlineKeyboardButton("🔗 API", callback_data="api"),
-            InlineKeyboardButton("🌐 Веб-плеер", url=WEBHOOK_URL or "https://telegram-music-bot-api-server.onrender.com")
+            InlineKeyboardButton("🌐 Веб-плеер", url=BASE_URL)
         ]
     ]
     
@@ -414,6 +1083,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def handle_audio_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка загрузки аудиофайлов"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    
     audio = update.message.audio
     user = update.effective_user
     
@@ -429,63 +1100,74 @@ async def handle_audio_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
     status_msg = await update.message.reply_text("⏳ Загружаю файл...")
     
     try:
-        # Получаем файл от Telegram
-        file = await context.bot.get_file(audio.file_id)
-        
-        # Извлекаем метаданные
-        title = audio.title or audio.file_name or "Unknown Title"
-        artist = audio.performer or "Unknown Artist"
-        duration = audio.duration or 0
-        
-        # Очищаем название от недопустимых символов
-        title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
-        artist = "".join(c for c in artist if c.isalnum() or c in (' ', '-', '_')).strip()
-        
-        # Генерируем уникальный ID и безопасное имя файла
-        track_id = str(uuid.uuid4())[:8]
-        file_hash = hashlib.md5(audio.file_id.encode()).hexdigest()[:8]
-        safe_filename = f"{track_id}_{file_hash}.mp3"
-        file_path = MUSIC_DIR / safe_filename
-        
-        # Скачиваем файл
-        await file.download_to_drive(file_path)
-        
-        # Сохраняем в базе данных
-        tracks_storage[track_id] = {
-            'id': track_id,
-            'title': title,
-            'artist': artist,
-            'file_path': str(file_path),
-            'file_id': audio.file_id,
-            'duration': duration,
-            'user_id': user.id,
-            'uploaded_at': datetime.now().isoformat(),
-            'play_count': 0
-        }
-        
-        save_tracks()
+        # Повторная отправка того же файла - отдаем ссылки на уже сохраненный трек
+        existing = find_duplicate(audio)
+        if existing:
+            track_id = existing['id']
+            title = existing['title']
+            artist = existing['artist']
+            duration = existing.get('duration', 0)
+            header = "ℹ️ *Этот трек уже загружен*"
+        else:
+            # Получаем файл от Telegram
+            file = await context.bot.get_file(audio.file_id)
+            
+            # Извлекаем метаданные
+            title = audio.title or audio.file_name or "Unknown Title"
+            artist = audio.performer or "Unknown Artist"
+            duration = audio.duration or 0
+            
+            # Очищаем название от недопустимых символов
+            title = SANITIZE_RE.sub('', title).strip()
+            artist = SANITIZE_RE.sub('', artist).strip()
+            
+            # Генерируем уникальный ID трека
+            track_id = uuid.uuid4().hex[:8]
+            while track_id in tracks_storage:
+                track_id = uuid.uuid4().hex[:8]
+            
+            # Скачиваем во временный файл, чтобы недокачанный трек не попал в API
+            tmp_path = MUSIC_DIR / f"{track_id}.mp3.part"
+            try:
+                # download_to_drive буферизует весь файл в памяти - пишем на диск по 64 KiB
+                content_hash = await stream_download(file.file_path, tmp_path)
+                
+                # Файл называется по хэшу содержимого: одинаковые файлы от разных
+                # пользователей хранятся один раз, треки просто ссылаются на него
+                file_path = MUSIC_DIR / f"{content_hash[:16]}.mp3"
+                await asyncio.to_thread(store_upload, tmp_path, file_path)
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            
+            # Сохраняем в базе данных (INSERT может ждать db_lock, пока пишутся счетчики)
+            await asyncio.to_thread(add_track, {
+                'id': track_id,
+                'title': title,
+                'artist': artist,
+                'file_path': str(file_path),
+                'file_id': audio.file_id,
+                'duration': duration,
+                'user_id': user.id,
+                'uploaded_at': datetime.now().isoformat(),
+                'play_count': 0
+            })
+            header = "✅ *Трек успешно загружен!*"
         
         # Формируем ответ
-        base_url = WEBHOOK_URL or "https://telegram-music-bot-api-server.onrender.com"
-        
-        success_text = f"""
-✅ *Трек успешно загружен!*
-
-🎵 *{title}*
-👤 {artist}
-⏱️ {duration//60}:{duration%60:02d}
-🆔 `{track_id}`
-
-*API ссылки:*
-▶️ Воспроизведение: `{base_url}/api/play/{track_id}`
-💾 Скачивание: `{base_url}/api/download/{track_id}`
-
-*Веб-плеер:* {base_url}
-        """
+        success_text = UPLOAD_TEMPLATE.format(
+            header=header,
+            title=title,
+            artist=artist,
+            minutes=duration // 60,
+            seconds=duration % 60,
+            track_id=track_id,
+            base_url=BASE_URL
+        )
         
         keyboard = [
             [
-                InlineKeyboardButton("🌐 Открыть веб-плеер", url=base_url)
+                InlineKeyboardButton("🌐 Открыть веб-плеер", url=BASE_URL)
             ],
             [
                 InlineKeyboardButton("📊 Статистика", callback_data="stats")
@@ -504,26 +1186,24 @@ async def handle_audio_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
         
     except Exception as e:
         logger.error(f"Audio upload error: {e}")
-        await status_msg.edit_text(f"❌ Ошибка при загрузке: {str(e)}")
+        # Текст исключения пользователю не показываем - в нем могут быть внутренние детали
+        await status_msg.edit_text("❌ Ошибка при загрузке, попробуйте еще раз")
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Статистика"""
     total_tracks = len(tracks_storage)
-    total_plays = sum(track.get('play_count', 0) for track in tracks_storage.values())
-    user_tracks = len([t for t in tracks_storage.values() if t.get('user_id') == update.effective_user.id])
+    user_tracks = user_track_counts[update.effective_user.id]
     
-    stats_text = f"""
-📊 *Статистика сервера*
-
-🎵 Всего треков: {total_tracks}
-▶️ Общее прослушиваний: {total_plays}
-👤 Ваших треков: {user_tracks}
-
-*Топ-3 треков:*
-"""
+    stats_text = STATS_TEMPLATE.format(
+        total_tracks=total_tracks,
+        total_plays=total_plays,
+        user_tracks=user_tracks
+    )
     
     # Топ треков по прослушиваниям
-    sorted_tracks = sorted(tracks_storage.values(), key=lambda x: x.get('play_count', 0), reverse=True)[:3]
+    # play_counts пополняется раньше upload_order - берем длину upload_order
+    top_positions = heapq.nlargest(3, range(len(upload_order)), key=play_counts.__getitem__)
+    sorted_tracks = [tracks_storage[upload_order[i]] for i in top_positions]
     
     for i, track in enumerate(sorted_tracks, 1):
         stats_text += f"{i}. {track['title']} ({track.get('play_count', 0)} ▶️)\n"
@@ -537,8 +1217,7 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     # Показываем последние 5 треков
-    tracks_list = list(tracks_storage.values())
-    recent_tracks = sorted(tracks_list, key=lambda x: x.get('uploaded_at', ''), reverse=True)[:5]
+    recent_tracks = [tracks_storage[track_id] for track_id in upload_order[:-6:-1]]
     
     list_text = f"📋 *Последние треки* ({len(tracks_storage)} всего):\n\n"
     
@@ -553,24 +1232,7 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def api_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """API информация"""
-    base_url = WEBHOOK_URL or "https://telegram-music-bot-api-server.onrender.com"
-    
-    api_text = f"""
-🔗 *API Документация*
-
-*Базовый URL:* `{base_url}`
-
-*Endpoints:*
-• `GET /api/tracks` - Все треки
-• `GET /api/search?q=запрос` - Поиск
-• `GET /api/play/ID` - Воспроизведение
-• `GET /api/download/ID` - Скачивание
-• `GET /api/stats` - Статистика
-
-*Веб-интерфейс:* {base_url}
-    """
-    
-    await update.message.reply_text(api_text, parse_mode='Markdown')
+    await update.message.reply_text(API_TEXT, parse_mode='Markdown')
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка нажатий кнопок"""
@@ -579,8 +1241,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     if query.data == "stats":
         total = len(tracks_storage)
-        plays = sum(track.get('play_count', 0) for track in tracks_storage.values())
-        text = f"📊 Треков: {total} | Прослушиваний: {plays}"
+        text = f"📊 Треков: {total} | Прослушиваний: {total_plays}"
         await query.edit_message_text(text)
         
     elif query.data == "list":
@@ -589,30 +1250,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(text)
         
     elif query.data == "api":
-        base_url = WEBHOOK_URL or "https://telegram-music-bot-api-server.onrender.com"
-        text = f"🔗 API доступен по адресу:\n{base_url}\n\nИспользуйте /api для подробной информации"
+        text = f"🔗 API доступен по адресу:\n{BASE_URL}\n\nИспользуйте /api для подробной информации"
         await query.edit_message_text(text)
 
-def run_flask_server():
-    """Запуск Flask сервера в отдельном потоке"""
+async def process_update(update):
+    """Обработка одного Telegram update (выполняется в event loop бота)"""
     try:
-        app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
+        await telegram_app.process_update(update)
     except Exception as e:
-        logger.error(f"Flask server error: {e}")
-
-async def process_telegram_updates():
-    """Обработка Telegram updates из очереди"""
-    while True:
-        try:
-            if not update_queue.empty():
-                update_data = update_queue.get_nowait()
-                if telegram_app:
-                    update = Update.de_json(update_data, telegram_app.bot)
-                    await telegram_app.process_update(update)
-            await asyncio.sleep(0.1)  # Небольшая пауза
-        except Exception as e:
-            logger.error(f"Update processing error: {e}")
-            await asyncio.sleep(1)
+        logger.error(f"Update processing error: {e}")
 
 async def setup_telegram_bot():
     """Настройка и создание Telegram бота"""
@@ -620,6 +1266,8 @@ async def setup_telegram_bot():
         logger.warning("BOT_TOKEN not configured - running in API-only mode")
         return None
     
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    
     try:
         # Создаем приложение
         application = Application.builder().token(BOT_TOKEN).build()
@@ -642,55 +1290,92 @@ async def setup_telegram_bot():
         logger.error(f"Failed to setup Telegram bot: {e}")
         return None
 
-async def main():
-    """Главная асинхронная функция"""
-    global telegram_app
-    
-    logger.info("🚀 Starting Telegram Music Bot + API Server")
+async def run_telegram_bot():
+    """Запуск Telegram бота в текущем event loop"""
+    global telegram_app, bot_loop, bot_stop
     
-    # Запускаем Flask сервер в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask_server, daemon=True)
-    flask_thread.start()
-    logger.info(f"🌐 Flask API server started on port {PORT}")
+    stop_event = asyncio.Event()
+    bot_stop = functools.partial(asyncio.get_running_loop().call_soon_threadsafe, stop_event.set)
     
     # Настраиваем Telegram бота
     telegram_app = await setup_telegram_bot()
     
-    if telegram_app and WEBHOOK_URL:
-        # Webhook режим для продакшена
-        webhook_url = f"{WEBHOOK_URL}/webhook"
-        await telegram_app.bot.set_webhook(url=webhook_url)
-        logger.info(f"🤖 Telegram bot webhook set to: {webhook_url}")
-        
-        # Запускаем обработчик updates
-        update_processor = asyncio.create_task(process_telegram_updates())
+    if not telegram_app:
+        logger.info("🤖 Running in API-only mode (no Telegram bot)")
+        return
+    
+    try:
+        await telegram_app.initialize()
+        await telegram_app.start()
         
-        # Держим приложение запущенным
-        try:
-            while True:
-                await asyncio.sleep(60)  # Проверяем каждую минуту
-        except KeyboardInterrupt:
-            logger.info("Shutting down...")
-            update_processor.cancel()
+        if WEBHOOK_URL:
+            # Webhook режим для продакшена
+            webhook_url = f"{WEBHOOK_URL}/webhook"
             
-    elif telegram_app:
-        # Polling режим для разработки
-        logger.info("🤖 Starting Telegram bot in polling mode")
-        await telegram_app.run_polling(drop_pending_updates=True)
+            # Webhook от прошлого деплоя остается активным - принимаем updates сразу,
+            # не дожидаясь ответа на set_webhook
+            bot_loop = asyncio.get_running_loop()
+            
+            # Соединений от Telegram не больше, чем updates мы обрабатываем одновременно
+            # (API допускает до 100), и только те типы updates, на которые есть обработчики
+            await telegram_app.bot.set_webhook(
+                url=webhook_url,
+                max_connections=min(MAX_UPDATES_IN_FLIGHT, 100),
+                allowed_updates=['message', 'callback_query']
+            )
+            logger.info(f"🤖 Telegram bot webhook set to: {webhook_url}")
+        else:
+            # Polling режим для разработки
+            logger.info("🤖 Starting Telegram bot in polling mode")
+            await telegram_app.updater.start_polling(drop_pending_updates=True)
         
-    else:
-        # Только API режим
-        logger.info("🤖 Running in API-only mode (no Telegram bot)")
-        try:
-            while True:
-                await asyncio.sleep(60)
-        except KeyboardInterrupt:
-            logger.info("Shutting down...")
+        # Держим event loop бота запущенным до остановки воркера
+        await stop_event.wait()
+    except Exception as e:
+        logger.error(f"Telegram bot error: {e}")
+    finally:
+        # Новые updates не принимаем - Telegram повторит их доставку следующему воркеру
+        bot_loop = None
+        await shutdown_telegram_bot()
 
-if __name__ == "__main__":
+async def shutdown_telegram_bot():
+    """Остановить бота и закрыть его HTTP соединения"""
+    global download_client
+    try:
+        if telegram_app.updater and telegram_app.updater.running:
+            await telegram_app.updater.stop()
+        if telegram_app.running:
+            await telegram_app.stop()
+        await telegram_app.shutdown()
+    except Exception as e:
+        logger.error(f"Telegram bot shutdown error: {e}")
+    
+    # Закрываем соединения клиента, через который скачиваются загрузки
+    if download_client is not None:
+        await download_client.aclose()
+        download_client = None
+    logger.info("🤖 Telegram bot stopped")
+
+def run_telegram_thread():
+    """Цикл событий бота в фоновом потоке"""
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Application stopped by user")
+        asyncio.run(run_telegram_bot())
     except Exception as e:
-        logger.error(f"Application error: {e}")
+        logger.error(f"Telegram bot error: {e}")
+
+def start_telegram_thread():
+    """Запуск бота рядом с WSGI сервером (вызывается из gunicorn.conf.py)"""
+    if not BOT_TOKEN:
+        # Без токена поток бота не нужен - заодно не импортируем telegram и httpx
+        logger.warning("BOT_TOKEN not configured - running in API-only mode")
+        return
+    global bot_thread
+    bot_thread = threading.Thread(target=run_telegram_thread, name="telegram-bot", daemon=True)
+    bot_thread.start()
+
+def stop_telegram_thread(timeout=10):
+    """Остановка бота при выходе воркера (вызывается из gunicorn.conf.py)"""
+    if bot_thread is None or not bot_thread.is_alive() or bot_stop is None:
+        return
+    bot_stop()
+    bot_thread.join(timeout)